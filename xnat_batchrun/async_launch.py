@@ -0,0 +1,92 @@
+"""
+Launch commands concurrently from a single thread using asyncio
+
+Requires the optional httpx package (and h2 for HTTP/2 support)
+"""
+import asyncio
+import importlib.util
+import logging
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .xnat_nott import http_error, retry_delay, xnat_session
+
+LOG = logging.getLogger(__name__)
+
+async def _retry(fn, max_retries=5, **kwargs):
+    """
+    Async equivalent of xnat_nott._retry for httpx requests
+
+    Only connection failures are retried, since in that case the request was never sent.
+    Launches are not idempotent so retrying after e.g. a read error could launch twice
+    """
+    for attempt in range(max_retries):
+        try:
+            r = await fn()
+        except (httpx.ConnectError, httpx.ConnectTimeout) as exc:
+            LOG.warning(f" - Request failed: {exc!r}")
+            delay = retry_delay(attempt, max_retries, **kwargs)
+            if delay is None:
+                raise
+        else:
+            if r.status_code < 300:
+                return r
+            delay = retry_delay(attempt, max_retries, r, **kwargs)
+            if delay is None:
+                raise http_error(r)
+
+        await asyncio.sleep(delay)
+
+async def run_command(client, semaphore, options, session, command, idx, throttle=True):
+    """
+    Launch a command on a single session, retrying on recoverable failures
+    """
+    command_name, session_id = command["command-name"], session["ID"]
+    params = {"session" : session_id}
+
+    async with semaphore:
+        if throttle:
+            await asyncio.sleep(options.sleep / options.workers)
+        LOG.info(f"Running command {command_name} on session {idx} {session_id} : {session['label']}")
+        await _retry(lambda: client.post(options.launch_url, params=params))
+        LOG.info(f"Started successfully on session {idx} {session_id}")
+
+async def _run_commands(options, sessions, command):
+    http2 = importlib.util.find_spec("h2") is not None
+    if not http2:
+        LOG.debug("h2 not available - using HTTP/1.1")
+
+    # Re-use the credentials from the existing login
+    requests_session = xnat_session(options)
+    cookies = requests_session.cookies.get_dict()
+
+    semaphore = asyncio.Semaphore(options.workers)
+    limits = httpx.Limits(max_connections=50)
+    # No timeout, as for the requests session - launches can be slow to respond
+    async with httpx.AsyncClient(http2=http2, verify=False, cookies=cookies, auth=requests_session.auth,
+                                 limits=limits, timeout=None) as client:
+        results = await asyncio.gather(*[
+            run_command(client, semaphore, options, session, command, idx, throttle=pos >= options.workers)
+            for pos, (idx, session) in enumerate(sessions)
+        ], return_exceptions=True)
+
+    failures = 0
+    for (idx, session), result in zip(sessions, results):
+        if isinstance(result, Exception):
+            LOG.error(f"Failed to run command on session {idx}: {session['label']}: {result!r}")
+            failures += 1
+    return failures
+
+def run_commands(options, sessions, command):
+    """
+    Launch a command on multiple sessions concurrently
+
+    :param sessions: Sequence of (index, session) tuples
+    :return: Number of sessions on which the command failed to launch
+    """
+    if httpx is None:
+        raise RuntimeError("Async mode requires the httpx package")
+    return asyncio.run(_run_commands(options, sessions, command))
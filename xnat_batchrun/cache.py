@@ -0,0 +1,67 @@
+"""
+Local cache of XNAT project/command metadata which changes rarely, so repeat
+runs can skip looking it up on the server
+"""
+import json
+import logging
+import os
+import re
+import time
+
+LOG = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "xnat-batchrun")
+EXPIRE_AFTER = 3600
+
+def _cache_fname(options):
+    # Lookups depend on the user's permissions so cache separately for each user
+    key = f"{options.user}@{options.host.split('://', 1)[-1]}"
+    key = re.sub(r"[^A-Za-z0-9.@-]+", "_", key)
+    return os.path.join(CACHE_DIR, f"metadata-{key}.json")
+
+def _load(options):
+    try:
+        with open(_cache_fname(options)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _save(options, data):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(_cache_fname(options), "w") as f:
+            json.dump(data, f)
+    except IOError:
+        LOG.warning("Failed to write metadata cache")
+
+def cached(options, section, key, fetch):
+    """
+    Get a metadata item from the cache, fetching it from XNAT if not cached or expired
+
+    :param section: Cache section, e.g. "projects"
+    :param key: Key of item within section
+    :param fetch: Function returning the item if not cached
+    """
+    if options.no_cache:
+        return fetch()
+
+    data = _load(options)
+    entry = data.get(section, {}).get(key)
+    if entry and time.time() - entry["timestamp"] < EXPIRE_AFTER:
+        LOG.debug(f"Using cached {section} entry for {key}")
+        return entry["value"]
+
+    value = fetch()
+    data.setdefault(section, {})[key] = {"timestamp" : time.time(), "value" : value}
+    _save(options, data)
+    return value
+
+def invalidate(options):
+    """
+    Remove all cached metadata for the XNAT host and user, e.g. when it appears to be out of date
+    """
+    LOG.info("Clearing cached metadata")
+    try:
+        os.remove(_cache_fname(options))
+    except FileNotFoundError:
+        pass
@@ -2,32 +2,89 @@
 XNAT-BATCHRUN: Run an XNAT container command on all sessions in a project
 """
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import itertools
 import logging
 import sys
-import time
+import threading
 
 from ._version import __version__
-from .xnat_nott import xnat_login, get_project, get_all_sessions, get_credentials, get_command, run_command, setup_logging
+from . import cache
 
 LOG = logging.getLogger(__name__)
 
+_worker = threading.local()
+
+def positive_int(value):
+    ivalue = int(value)
+    if ivalue < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return ivalue
+
+def non_negative_int(value):
+    ivalue = int(value)
+    if ivalue < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {value}")
+    return ivalue
+
 class ArgumentParser(argparse.ArgumentParser):
     def __init__(self, **kwargs):
-        argparse.ArgumentParser.__init__(self, prog="xnat-batchrun", add_help=False, **kwargs)
+        argparse.ArgumentParser.__init__(self, prog="xnat-batchrun", **kwargs)
         self.add_argument("--host", help="XNAT host", required=True)
         self.add_argument("--project", help="XNAT project", required=True)
         self.add_argument("--user", help="XNAT username")
         self.add_argument("--command", help="Name of command to run")
-        self.add_argument("--sleep", help="Time to sleep between commands in seconds", type=int, default=60)
-        self.add_argument("--skip", help="Number of sessions to skip", type=int, default=0)
+        self.add_argument("--sleep", help="Time in seconds divided by the number of workers that each worker sleeps between its own launches, so the overall launch rate is up to workers^2/sleep per second", type=int, default=60)
+        self.add_argument("--workers", help="Number of commands to launch in parallel", type=positive_int, default=8)
+        launch_mode = self.add_mutually_exclusive_group()
+        launch_mode.add_argument("--async", dest="use_async", help="Launch commands concurrently using asyncio (requires httpx)", action="store_true", default=False)
+        launch_mode.add_argument("--bulk", help="Launch commands using container service bulk launch requests", action="store_true", default=False)
+        self.add_argument("--bulk-size", help="Maximum number of sessions per bulk launch request (0 for no limit)", type=non_negative_int, default=50)
+        self.add_argument("--skip", help="Number of sessions to skip, in the order they are listed. Launches run in parallel so to resume a failed run, re-run the failed sessions reported in the log", type=int, default=0)
+        self.add_argument("--no-cache", help="Do not use locally cached project/command details", action="store_true", default=False)
         self.add_argument("--yes", help="Run without prompting", action="store_true", default=False)
         self.add_argument("--debug", help="Use debug logging")
 
+def launch(run_command, stop, options, project, session, command, idx):
+    """
+    Launch a command on a session from a worker thread
+
+    Each worker sleeps for sleep/workers between its own launches, so the overall launch
+    rate is up to workers^2/sleep per second and the first launch of every worker starts
+    immediately
+
+    :param stop: threading.Event set when the run is interrupted, in which case the
+                 command is not launched
+    """
+    if getattr(_worker, "launched", False):
+        stop.wait(options.sleep / options.workers)
+    if stop.is_set():
+        return
+    _worker.launched = True
+    run_command(options, project, session, command, idx=idx)
+
+def chunks(items, size):
+    """
+    Split a sequence into chunks of a maximum size, or a single chunk if size is 0
+    """
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size or None))
+        if not chunk:
+            return
+        yield chunk
+
 def main():
     """
     Main script entry point
     """
     options = ArgumentParser().parse_args()
+
+    # Deferred so that argument errors and --help do not pay the cost of importing requests
+    from .xnat_nott import (
+        xnat_login, xnat_logout, get_project, get_all_sessions, get_credentials, get_command,
+        get_launch_url, prepare_launch_request, run_command, run_command_bulk, setup_logging
+    )
     setup_logging(options)
 
     LOG.info(f"XNAT batch run v{__version__}")
@@ -36,14 +93,17 @@ def main():
         get_credentials(options)
         xnat_login(options)
 
-        project = get_project(options, options.project)
+        project = cache.cached(options, "projects", options.project.lower(),
+                               lambda: get_project(options, options.project))
         LOG.info(f"Found project: ID {project['ID']}")
 
         sessions = get_all_sessions(options, project)
         LOG.info(f"Found {len(sessions)} sessions")
 
-        command = get_command(options, project, options.command)
+        command = cache.cached(options, "commands", f"{project['ID']}/{options.command}",
+                               lambda: get_command(options, project, options.command))
         LOG.info(f"Found command {options.command} with ID {command['command-id']} / {command['wrapper-id']}")
+        options.launch_url = get_launch_url(options, project, command)
 
         if not options.yes:
             confirm = input(f"Run command {options.command} on {len(sessions)} sessions? (yes/no): ")
@@ -51,16 +111,59 @@ def main():
                 LOG.info("Aborting run")
                 sys.exit(1)
 
-        for idx, session in enumerate(sessions):
-            if idx >= options.skip:
-                run_command(options, project, session, command, idx=idx)
-                time.sleep(options.sleep)
-            else:
-                LOG.info(f"Skipping session {idx}: {session['label']}")
+        if not options.bulk and not options.use_async:
+            # Prepared after confirmation so the session credentials are current
+            options.launch_request = prepare_launch_request(options)
+
+        for idx, session in enumerate(sessions[:options.skip]):
+            LOG.info(f"Skipping session {idx}: {session['label']}")
+
+        failures = 0
+        if options.bulk:
+            for chunk in chunks(sessions[options.skip:], options.bulk_size):
+                try:
+                    failures += run_command_bulk(options, project, chunk, command)
+                except Exception as exc:
+                    LOG.error(f"Failed to run command on {len(chunk)} sessions {chunk[0]['label']} ... {chunk[-1]['label']}: {exc}")
+                    failures += len(chunk)
+        elif options.use_async:
+            from .async_launch import run_commands
+            failures = run_commands(options, list(enumerate(sessions))[options.skip:], command)
+        else:
+            stop = threading.Event()
+            with ThreadPoolExecutor(max_workers=options.workers) as executor:
+                try:
+                    futures = {
+                        executor.submit(launch, run_command, stop, options, project, session, command, idx) : (idx, session)
+                        for idx, session in enumerate(sessions) if idx >= options.skip
+                    }
+                    for future in as_completed(futures):
+                        idx, session = futures[future]
+                        try:
+                            future.result()
+                        except Exception as exc:
+                            LOG.error(f"Failed to run command on session {idx}: {session['label']}: {exc}")
+                            failures += 1
+                except BaseException:
+                    # e.g. Ctrl-C - do not start any more launches
+                    LOG.warning("Interrupted - cancelling remaining launches")
+                    stop.set()
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+        if failures:
+            # Failures may be caused by out of date cached project/command details
+            cache.invalidate(options)
+            raise RuntimeError(f"Failed to run command on {failures} sessions")
 
     except Exception as exc:
+        if getattr(getattr(exc, "response", None), "status_code", None) == 404:
+            # Cached project/command details may be out of date
+            cache.invalidate(options)
         LOG.exception("Unexpected error")
         sys.exit(1)
+    finally:
+        xnat_logout(options)
 
 if __name__ == "__main__":
     main()
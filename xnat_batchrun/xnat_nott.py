@@ -8,9 +8,13 @@ import io
 import json
 import logging
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import remove_cookie_by_name
 import sys
 import tempfile
+import time
 import urllib, urllib3
 
 import xmltodict
@@ -41,6 +45,25 @@ def convert_dicoms(dicomdir, niftidir):
         return None
     return niftidir
 
+def xnat_session(options):
+    """
+    Get the persistent HTTP session used for all XNAT requests, creating it if necessary
+
+    Re-using a single session enables keep-alive and connection pooling so we do not
+    pay for a new TCP/TLS handshake on every request
+    """
+    session = getattr(options, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.verify = False
+        session.headers.update({"Accept-Encoding" : "gzip, deflate"})
+        pool_size = max(20, getattr(options, "workers", 1))
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        options.session = session
+    return session
+
 def get_host_url(options):
     """
     Get the 'real' URL for XNAT, since it may be subject to redirects and these mess up POST/PUT requests
@@ -48,7 +71,7 @@ def get_host_url(options):
     if not options.host:
         options.host = os.environ["XNAT_HOST"]
     LOG.info(f"Checking host URL: {options.host}")
-    r = requests.get(options.host, verify=False, allow_redirects=False)
+    r = xnat_session(options).get(options.host, allow_redirects=False)
     if r.status_code in (301, 302):
         new_host = r.headers['Location']
         LOG.info(f" - Redirect detected: {new_host}")
@@ -76,8 +99,7 @@ def get_projects(options):
     LOG.debug(f"Getting projects")
     try:
         params={"format" : "csv"}
-        csvdata = xnat_get(options, "data/projects/", params=params)
-        return list(csv.DictReader(io.StringIO(csvdata)))
+        return xnat_get_csv(options, "data/projects/", params=params)
     except:
         LOG.exception("Error getting projects")
         return []
@@ -88,6 +110,18 @@ def get_project(options, project_identifier):
 
     :param project_identifier: Case insensitive identifier, may be ID or name
     """
+    # Common case is that we have been given the project ID so try fetching it directly
+    # before falling back on searching the full project listing
+    url = f"{options.host}/data/projects/{urllib.parse.quote(project_identifier, safe='')}"
+    LOG.debug(f"Checking for project ID {project_identifier}")
+    try:
+        r = xnat_session(options).get(url, params={"format" : "json"})
+        if r.status_code == 200:
+            return r.json()["items"][0]["data_fields"]
+        LOG.debug(f" - status: {r.status_code}")
+    except (requests.RequestException, ValueError, KeyError, IndexError):
+        LOG.debug(" - Failed to get project directly")
+
     project_identifier = project_identifier.lower()
     projects = get_projects(options)
     for p in projects:
@@ -104,9 +138,7 @@ def get_subjects(options, project):
     project_id = project["ID"]
     LOG.debug(f"Getting subjects for prject {project_id}")
     params={"format" : "csv"}
-    csvdata = xnat_get(options, f"data/projects/{project_id}/subjects/", params=params)
-    subjects = list(csv.DictReader(io.StringIO(csvdata)))
-    return subjects
+    return xnat_get_csv(options, f"data/projects/{project_id}/subjects/", params=params)
 
 def get_sessions(options, project, subject):
     """
@@ -118,8 +150,7 @@ def get_sessions(options, project, subject):
     sessions = []
 
     params = {"xsiType": "xnat:mrSessionData", "format" : "csv"}
-    csvdata = xnat_get(options, f"data/projects/{project_id}/subjects/{subject_id}/experiments/", params=params)
-    for session in list(csv.DictReader(io.StringIO(csvdata))):
+    for session in xnat_get_csv(options, f"data/projects/{project_id}/subjects/{subject_id}/experiments/", params=params):
         session["subject"] = subject_id
         session["subject_label"] = subject['label']
         sessions.append(session)
@@ -149,9 +180,8 @@ def get_assessors(options, session, assessor_xsitype):
     session_id = session["ID"]
     LOG.debug(f"Getting assessors for session {session_id}")
     params={"format" : "csv", "xsiType" : assessor_xsitype, "columns" : "ID"}
-    csvdata = xnat_get(options, f"data/experiments/{session_id}/assessors/", params=params)
     assessors = []
-    for row in csv.DictReader(io.StringIO(csvdata), skipinitialspace=True):
+    for row in xnat_get_csv(options, f"data/experiments/{session_id}/assessors/", params=params, skipinitialspace=True):
         assessor_id = row['ID']
         assessor_xml = xnat_get(options, f"data/experiments/{session_id}/assessors/{assessor_id}", params={"format" : "xml"})
         assessor = xmltodict.parse(assessor_xml)[assessor_xsitype]
@@ -164,27 +194,82 @@ def get_command(options, project, command_name):
     project_id = project["ID"]
     LOG.info(f"Getting commands for project {project_id}")
     params = {"project" : project_id, "xsiType" : "xnat:mrSessionData"}
-    jsondata = xnat_get(options, "/xapi/commands/available", params=params)
-    commands = json.loads(jsondata)
-    command = [c for c in commands if c["command-name"] == command_name]
-    if not command:
+    commands = xnat_get_json(options, "/xapi/commands/available", params=params)
+    matches = (c for c in commands if c["command-name"] == command_name)
+    command = next(matches, None)
+    if command is None:
         known_commands = [c["command-name"] for c in commands]
         raise RuntimeError(f"Unable to find command {options.command} - known commands: {known_commands}")
-    if len(command) > 1:
+    if next(matches, None) is not None:
         LOG.warn("Multiple commands found - returning first")
-    return command[0]
+    return command
+
+def get_launch_url(options, project, command):
+    """
+    :return: Full URL used to launch a command on a session
+    """
+    project_id, command_id, wrapper_id = project["ID"], command["command-id"], command["wrapper-id"]
+    return f"{options.host}/xapi/projects/{project_id}/commands/{command_id}/wrappers/{wrapper_id}/launch/"
+
+def prepare_launch_request(options):
+    """
+    Prepare a template command launch request for options.launch_url
+
+    Headers, cookies and auth are merged from the session once here, so each launch
+    only needs to fill in the session parameter
+    """
+    request = requests.Request("POST", options.launch_url)
+    return xnat_session(options).prepare_request(request)
 
 def run_command(options, project, session, command, idx=""):
-    command_name, command_id, wrapper_id = command["command-name"], command["command-id"], command["wrapper-id"]
-    project_id, session_id = project["ID"], session["ID"]
+    """
+    Launch a command on a session
+
+    Uses options.launch_request (see prepare_launch_request) or options.launch_url if set
+    to avoid rebuilding the request for every session
+    """
+    command_name, session_id = command["command-name"], session["ID"]
     LOG.info(f"Running command {command_name} on session {idx} {session_id} : {session['label']}")
 
-    url = f"xapi/projects/{project_id}/commands/{command_id}/wrappers/{wrapper_id}/launch/"
     params = {"session" : session_id}
-    xnat_get(options, url, params=params, method="POST")
+    template = getattr(options, "launch_request", None)
+    if template is not None:
+        prepared = template.copy()
+        prepared.prepare_url(options.launch_url, params)
+        _retry(lambda: xnat_session(options).send(prepared))
+    else:
+        url = getattr(options, "launch_url", None) or get_launch_url(options, project, command)
+        xnat_get(options, url, params=params, method="POST")
 #        LOG.warning(f"Failed to run command on session {session_id}: {r.text} after 10 attempts")
     LOG.info("Started successfully")
 
+def run_command_bulk(options, project, sessions, command):
+    """
+    Run a command on multiple sessions using a single container service bulk launch request
+
+    Uses the bulklaunch endpoint of the container service plugin (LaunchRestApi, 2.x and 3.x),
+    as used by the XNAT UI. The request body is a single parameter map in which the root
+    element ('session') maps to a JSON-encoded list of session IDs. The response is a
+    BulkLaunchReport with 'successes' and 'failures' lists. In 3.x launches are queued,
+    so a success means the launch was accepted rather than that the container started
+
+    :return: Number of sessions on which the command failed to launch
+    """
+    command_name, wrapper_id = command["command-name"], command["wrapper-id"]
+    project_id = project["ID"]
+    LOG.info(f"Running command {command_name} on {len(sessions)} sessions: {sessions[0]['label']} ... {sessions[-1]['label']}")
+
+    url = f"xapi/projects/{project_id}/wrappers/{wrapper_id}/root/session/bulklaunch"
+    launch_params = {"session" : json.dumps([session["ID"] for session in sessions])}
+    report = _xnat_request(options, url, method="POST", json=launch_params).json()
+    if "successes" not in report and "failures" not in report:
+        raise RuntimeError(f"Unexpected bulk launch response: {report}")
+    failures = report.get("failures", [])
+    for failure in failures:
+        LOG.warning(f"Failed to run command: {failure.get('params', {})} {failure.get('message', '')}")
+    LOG.info(f"Started successfully on {len(report.get('successes', []))} sessions")
+    return len(failures)
+
 def xnat_login(options):
     """
     Attempt to use the auth service to log in but fall back on HTTP basic auth if not working
@@ -192,51 +277,161 @@ def xnat_login(options):
     url = f"{options.host}/data/services/auth"
     auth_params={"username" : options.user, "password" : options.password}
     LOG.info(f"Attempting log in: {url}")
-    r = requests.put(url, verify=False, data=urllib.parse.urlencode(auth_params))
+    session = xnat_session(options)
+    session.auth = None
+    remove_cookie_by_name(session.cookies, "JSESSIONID")
+    r = session.put(url, data=urllib.parse.urlencode(auth_params))
     LOG.debug(f"status: {r.status_code}")
     if r.status_code == 200:
         LOG.info(" - Logged in using auth service")
-        options.cookies = {"JSESSIONID" : r.text}
-        options.auth = None
+        # Server may also have set the cookie - replace it so we only have one
+        remove_cookie_by_name(session.cookies, "JSESSIONID")
+        session.cookies["JSESSIONID"] = r.text
     else:
         LOG.info(f" - Failed to log in using auth service - will use basic auth instead")
-        options.cookies = {}
-        options.auth = (options.user, options.password)
+        session.auth = (options.user, options.password)
     LOG.info("DONE login")
 
-def xnat_get(options, url, params=None, method="GET"):
+def xnat_logout(options):
     """
-    Get text content from XNAT, e.g. CSV/XML data
+    End the XNAT session so the server can free it, and close pooled connections
     """
-    LOG.debug(f"Executing GET on {options.host}")
-    url = url.lstrip("/")
-    url = f"{options.host}/{url}"
+    session = getattr(options, "session", None)
+    if session is None:
+        return
+    if "JSESSIONID" in session.cookies:
+        LOG.info("Logging out")
+        try:
+            r = session.delete(f"{options.host}/data/JSESSION")
+            LOG.debug(f"status: {r.status_code}")
+        except requests.RequestException:
+            LOG.warning(" - Failed to log out")
+    session.close()
+    options.session = None
+
+def is_recoverable(status_code):
+    """
+    :return: True if an HTTP error status is worth retrying, e.g. server errors and timeouts.
+             Other client errors (e.g. authentication failures) will not succeed on retry
+    """
+    return status_code >= 500 or status_code in (408, 429)
+
+def backoff_delay(attempt, base=1.0, cap=30.0, jitter=0.5):
+    """
+    :return: Capped exponential backoff delay in seconds with random jitter
+    """
+    return min(cap, base * (2 ** attempt)) * (1 + random.uniform(0, jitter))
+
+def retry_delay(attempt, max_retries, response=None, base=1.0, cap=30.0, jitter=0.5):
+    """
+    Decide whether to retry a failed request attempt
+
+    :param response: Unsuccessful response, or None if the request raised a connection error
+    :return: Delay in seconds before the next attempt, or None if the request should not be retried
+    """
+    if response is not None:
+        LOG.warning(f" - Request failed: {response.status_code}")
+        if not is_recoverable(response.status_code):
+            return None
+    if attempt == max_retries - 1:
+        return None
+    delay = backoff_delay(attempt, base, cap, jitter)
+    LOG.info(f" - Retrying in {delay:.1f}s")
+    return delay
+
+def http_error(r):
+    """
+    :return: requests.HTTPError for an unsuccessful response
+    """
+    return requests.HTTPError(f"{r.status_code} error for url: {r.url}", response=r)
+
+def _retry(fn, max_retries=5, exceptions=(requests.ConnectionError, requests.Timeout), **kwargs):
+    """
+    Call a function returning an HTTP response, retrying with exponential backoff
+    on recoverable failures
+
+    :param exceptions: Exception types raised by fn which may be retried
+    :param kwargs: Backoff parameters for retry_delay
+    :return: Successful response
+    :raises: requests.HTTPError on unrecoverable errors or when retries are exhausted
+    """
+    for attempt in range(max_retries):
+        try:
+            r = fn()
+        except exceptions as exc:
+            LOG.warning(f" - Request failed: {exc}")
+            delay = retry_delay(attempt, max_retries, **kwargs)
+            if delay is None:
+                raise
+        else:
+            if r.status_code < 300:
+                return r
+            delay = retry_delay(attempt, max_retries, r, **kwargs)
+            if delay is None:
+                raise http_error(r)
+            r.close()
+
+        time.sleep(delay)
+
+def _xnat_request(options, url, params=None, method="GET", **kwargs):
+    """
+    Execute a request on XNAT with retries
+
+    :return: Successful response
+    """
+    LOG.debug(f"Executing {method} on {options.host}")
+    if not url.startswith(options.host):
+        url = url.lstrip("/")
+        url = f"{options.host}/{url}"
     LOG.debug(f" - URL: {url}")
-    tries = 0
-    method_impl = getattr(requests, method.lower(), None)
+    method_impl = getattr(xnat_session(options), method.lower(), None)
     if not method_impl:
         raise RuntimeError(f"No such HTTP method: {method}")
 
-    while tries < 10:
-        tries += 1
-        r = method_impl(url, verify=False, cookies=options.cookies, auth=options.auth, params=params)
-        if r.status_code == 200:
-            break
-    if r.status_code != 200:
-        raise RuntimeError(f"Failed to execute {method} after 10 tries: {r.status_code} {r.text}")
-    return r.text
+    return _retry(lambda: method_impl(url, params=params, **kwargs))
+
+def xnat_get(options, url, params=None, method="GET"):
+    """
+    Get text content from XNAT, e.g. CSV/XML data
+    """
+    return _xnat_request(options, url, params=params, method=method).text
+
+def xnat_get_json(options, url, params=None):
+    """
+    Get JSON data from XNAT
+    """
+    return _xnat_request(options, url, params=params).json()
+
+def xnat_get_csv(options, url, params=None, **kwargs):
+    """
+    Get CSV data from XNAT
+
+    The response is streamed directly into the CSV parser rather than decoded
+    into a single string first
+
+    :param kwargs: Additional arguments for csv.DictReader
+    :return: List of row dictionaries
+    """
+    with _xnat_request(options, url, params=params, stream=True) as r:
+        LOG.debug(f" - Content encoding: {r.headers.get('Content-Encoding', 'none')}")
+        # Read decoded text from the raw stream so line endings within quoted fields are preserved
+        r.raw.decode_content = True
+        # urllib3 closes the stream once Content-Length bytes are read, before TextIOWrapper sees EOF
+        r.raw.auto_close = False
+        return list(csv.DictReader(io.TextIOWrapper(r.raw, encoding="utf-8", newline=""), **kwargs))
 
 def xnat_download(options, url, params=None, local_fname=None):
     LOG.info(f"Downloading data from {options.host}")
     url = url.lstrip("/")
     url = f"{options.host}/{url}"
     LOG.info(f" - URL: {url}")
-    r = requests.get(url, verify=False, cookies=options.cookies, auth=options.auth, params=params, stream=True)
+    session = xnat_session(options)
+    r = session.get(url, params=params, stream=True)
     LOG.debug(f" - status: {r.status_code}")
     if r.status_code == 401:
         print(" - Session expired, will re-login and retry")
         xnat_login(options)
-        r = requests.get(url, verify=False, cookies=options.cookies, auth=options.auth, params=params, stream=True)
+        r = session.get(url, params=params, stream=True)
     r.raise_for_status()
 
     if not local_fname:
@@ -264,18 +459,19 @@ def xnat_upload(options, url, local_fname, replace_assessor=None):
     url = f"{options.host}/{url}"
     LOG.info(f" - URL: {url}")
 
+    session = xnat_session(options)
     with open(local_fname, "r") as f:
         files = {'file': f}
         url = f"{options.host}/{url}"
         while True:
-            r = requests.post(url, files=files, auth=options.auth, cookies=options.cookies, verify=False, allow_redirects=False) 
+            r = session.post(url, files=files, allow_redirects=False)
             if r.status_code == 409:
                 LOG.info(" - File already exists")
                 if replace_assessor:
                     LOG.info(" - will delete and replace")
                     delete_url = url + replace_assessor
                     LOG.info(f" - Delete URL: {delete_url}")
-                    r = requests.delete(delete_url, auth=options.auth, cookies=options.cookies, verify=False)
+                    r = session.delete(delete_url)
                     if r.status_code == 200:
                         LOG.info(" - Delete successful - re-posting")
                         f.seek(0)